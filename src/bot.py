@@ -1,22 +1,33 @@
 # SPDX-License-Identifier: MIT
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
 import hashlib
+import json
+import time
+from contextlib import asynccontextmanager
+from dataclasses import asdict
 from datetime import datetime, timedelta, date
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 import httpx
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
 
 from telegram import Update
 from telegram.constants import ParseMode
 from telegram.ext import ApplicationBuilder, Application, CommandHandler, ContextTypes
+from telegram.request import HTTPXRequest
 
 from .memory.rest import RestMemory, make_fingerprint
 from .providers.base import BaseProvider
 from .providers.dummy import DummyProvider
-from .providers.traderepublic import TradeRepublicProvider
+from .providers.traderepublic import DEFAULT_UNIVERSE, EvalResult, TradeRepublicProvider, make_client
 
 # ---------- ENV ----------
 REDIS_PREFIX = os.getenv("REDIS_PREFIX", "trbot")
@@ -24,6 +35,7 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
 PORT = int(os.getenv("PORT", "10000"))
 TZ = os.getenv("TZ", "Europe/Madrid")
+TZ_INFO = ZoneInfo(TZ)
 DAY_OFFSET_DEFAULT = int(os.getenv("DAY_OFFSET_DEFAULT", "1"))
 TOP_K = int(os.getenv("TOP_K", "4"))
 MEMORY_TTL_DAYS = int(os.getenv("MEMORY_TTL_DAYS", "14"))
@@ -31,6 +43,8 @@ MEMORY_NAMESPACE = os.getenv("MEMORY_NAMESPACE", "pickmem")
 REDIS_REST_URL = os.getenv("REDIS_REST_URL", "")
 REDIS_REST_TOKEN = os.getenv("REDIS_REST_TOKEN", "")
 PROVIDER_NAME = os.getenv("PROVIDER", "dummy")
+ITEMS_CACHE_TTL = float(os.getenv("ITEMS_CACHE_TTL", "60"))  # segundos; 0 desactiva la caché
+MAX_MSG_CHARS = 3500  # margen bajo el límite de 4096 caracteres de Telegram
 
 if not TELEGRAM_BOT_TOKEN:
     raise RuntimeError("Missing TELEGRAM_BOT_TOKEN")
@@ -46,39 +60,40 @@ logger = logging.getLogger("bot")
 # ===== Decoradores de texto con emojis =====
 DISCLAIMER = "— ℹ️ Información educativa; *no es consejo financiero* —"
 
+_DECISION = {
+    "COMPRAR": "🟢 COMPRAR",
+    "MANTENER": "🟡 MANTENER",
+    "VENDER": "🔴 VENDER",
+    "EVITAR": "⚪️ EVITAR",
+}
+_HORIZON = {
+    "Corto": "⏱️ Corto",
+    "Medio": "🕰️ Medio",
+    "Largo": "🧭 Largo",
+    "Observación": "👀 Observación",
+}
+_RISK = {
+    "Bajo": "🟩 Bajo",
+    "Medio": "🟨 Medio",
+    "Alto": "🟥 Alto",
+}
+_CONF = {
+    "Alta": "🔷 Alta",
+    "Media": "🔸 Media",
+    "Baja": "🔹 Baja",
+}
+
 def deco_decision(dec: str) -> str:
-    mapa = {
-        "COMPRAR": "🟢 COMPRAR",
-        "MANTENER": "🟡 MANTENER",
-        "VENDER": "🔴 VENDER",
-        "EVITAR": "⚪️ EVITAR",
-    }
-    return mapa.get(dec, dec)
+    return _DECISION.get(dec, dec)
 
 def deco_horizon(h: str) -> str:
-    mapa = {
-        "Corto": "⏱️ Corto",
-        "Medio": "🕰️ Medio",
-        "Largo": "🧭 Largo",
-        "Observación": "👀 Observación",
-    }
-    return mapa.get(h, h)
+    return _HORIZON.get(h, h)
 
 def deco_risk(r: str) -> str:
-    mapa = {
-        "Bajo": "🟩 Bajo",
-        "Medio": "🟨 Medio",
-        "Alto": "🟥 Alto",
-    }
-    return mapa.get(r, r)
+    return _RISK.get(r, r)
 
 def deco_conf(c: str) -> str:
-    mapa = {
-        "Alta": "🔷 Alta",
-        "Media": "🔸 Media",
-        "Baja": "🔹 Baja",
-    }
-    return mapa.get(c, c)
+    return _CONF.get(c, c)
 # ===== Fin helpers =====
 
 # ---------- Proveedor ----------
@@ -90,37 +105,131 @@ def get_provider(name: str) -> BaseProvider:
         return DummyProvider()
     return DummyProvider()
 
+# Caché en proceso (TTL + single-flight): usuarios concurrentes comparten la misma petición al proveedor
+_ITEMS_CACHE_MAX = 64
+_items_cache: Dict[Tuple[Any, ...], Tuple[float, "asyncio.Future[List[Dict[str, Any]]]"]] = {}
+
+async def get_items_cached(provider: BaseProvider, day_from: date, day_to: date, top_k: Optional[int]) -> List[Dict[str, Any]]:
+    key = (PROVIDER_NAME, day_from, day_to, top_k)
+    now = time.monotonic()
+    hit = _items_cache.get(key)
+    if hit and now - hit[0] < ITEMS_CACHE_TTL:
+        fut = hit[1]
+    else:
+        fut = asyncio.ensure_future(provider.get_items(day_from, day_to, top_k=top_k))
+        _items_cache.pop(key, None)
+        _items_cache[key] = (now, fut)
+        if len(_items_cache) > _ITEMS_CACHE_MAX:
+            _items_cache.pop(next(iter(_items_cache)))  # el más antiguo
+    try:
+        # shield: si un usuario cancela, la petición compartida sigue para los demás
+        return list(await asyncio.shield(fut))
+    except Exception:
+        if _items_cache.get(key, (0.0, None))[1] is fut:
+            _items_cache.pop(key, None)  # no cachear errores
+        raise
+
 # ---------- Utilidades ----------
+_today_cache: Tuple[float, Optional[date]] = (float("-inf"), None)
+
+def today_local() -> date:
+    """Fecha actual en TZ, recalculada como mucho una vez por segundo."""
+    global _today_cache
+    now = time.monotonic()
+    ts, d = _today_cache
+    if d is None or now - ts >= 1.0:
+        d = datetime.now(TZ_INFO).date()
+        _today_cache = (now, d)
+    return d
+
 def parse_date_arg(arg: str) -> date:
-    from datetime import datetime as dt
-    for fmt in ("%d/%m/%Y", "%d/%m/%y"):
-        try:
-            return dt.strptime(arg.strip(), fmt).date()
-        except ValueError:
-            pass
-    raise ValueError("Formato de fecha no válido. Usa dd/mm/aaaa (p.ej. 21/08/2025).")
+    arg = arg.strip()
+    try:
+        return datetime.strptime(arg, "%d/%m/%Y").date()
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(arg, "%d/%m/%y").date()
+    except ValueError:
+        raise ValueError("Formato de fecha no válido. Usa dd/mm/aaaa (p.ej. 21/08/2025).") from None
+
+_ITEM_TPL = "{league_txt}{dt_txt}\n• {name}\n• {market}: *{selection}* @ *{price}*{value_txt}\nFuente: {src}"
+_IDEA_TPL = (
+    "{icon} *{symbol}* ({name}) — {price:.2f}\n"
+    "{decision} | Horizonte: {horizonte}\n"
+    "🧮 Score: *{score}/100* | 🤝 Confianza: {confianza} | ⚖️ Riesgo: {riesgo}\n"
+    "🧠 Razón: {razon}"
+)
 
 def fmt_item(item: Dict[str, Any]) -> str:
-    dt_txt = item.get("date", "")
     league = item.get("league") or item.get("category") or ""
-    name = item.get("name", "")
-    market = item.get("market", "")
-    selection = item.get("selection", "")
-    price = item.get("price", "")
-    src = item.get("source", "")
     value = item.get("value")
-    value_txt = f"\nValor: {value:+.2%}" if isinstance(value, (int, float)) else ""
-    league_txt = f"[{league}] " if league else ""
-    return (
-        f"{league_txt}{dt_txt}\n"
-        f"• {name}\n"
-        f"• {market}: *{selection}* @ *{price}*{value_txt}\n"
-        f"Fuente: {src}"
+    return _ITEM_TPL.format(
+        league_txt=f"[{league}] " if league else "",
+        dt_txt=item.get("date", ""),
+        name=item.get("name", ""),
+        market=item.get("market", ""),
+        selection=item.get("selection", ""),
+        price=item.get("price", ""),
+        value_txt=f"\nValor: {value:+.2%}" if isinstance(value, (int, float)) else "",
+        src=item.get("source", ""),
+    )
+
+def fmt_eval(r: EvalResult, icon: str) -> str:
+    return _IDEA_TPL.format(
+        icon=icon,
+        symbol=r.symbol,
+        name=r.name,
+        price=r.price,
+        decision=deco_decision(r.decision),
+        horizonte=deco_horizon(r.horizonte),
+        score=r.score,
+        confianza=deco_conf(r.confianza),
+        riesgo=deco_risk(r.riesgo_cat),
+        razon=r.razon,
     )
 
-def build_fingerprint_payload(item: Dict[str, Any]) -> str:
-    keys = ["date", "league", "name", "market", "selection"]
-    return "|".join(str(item.get(k, "")) for k in keys)
+def pack_messages(parts: Iterable[str], limit: int = MAX_MSG_CHARS, footer: str = "") -> List[str]:
+    """Agrupa bloques de texto en el mínimo de mensajes de hasta `limit` caracteres (`footer` en cada uno)."""
+    if footer:
+        # Se reserva sitio para el pie en cada mensaje
+        return [f"{c}\n{footer}" for c in pack_messages(parts, limit - len(footer) - 1)]
+    chunks: List[str] = []
+    cur = ""
+    for part in parts:
+        if cur and len(cur) + 2 + len(part) > limit:
+            chunks.append(cur)
+            cur = part
+        else:
+            cur = f"{cur}\n\n{part}" if cur else part
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+async def reply_chunks(update: Update, parts: Iterable[str], footer: str = "") -> None:
+    # Un POST por bloque agrupado (no por item); en orden para no mezclar mensajes
+    for chunk in pack_messages(parts, footer=footer):
+        await update.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN)
+
+_REQUIRED_ITEM_KEYS = ("date", "name", "market", "selection")
+
+def is_valid_item(item: Any) -> bool:
+    """Item mínimo para deduplicar y renderizar: dict con los campos clave como str no vacíos."""
+    if not isinstance(item, dict):
+        return False
+    for k in _REQUIRED_ITEM_KEYS:
+        v = item.get(k)
+        if not v or not isinstance(v, str):
+            return False
+    return True
+
+_FP_KEYS = ("date", "league", "name", "market", "selection")
+
+def build_fingerprint_payload(item: Dict[str, Any], _keys: Tuple[str, ...] = _FP_KEYS) -> str:
+    get = item.get
+    vals = [get(k, "") for k in _keys]
+    # str() solo si hace falta (los proveedores ya devuelven casi todo como str)
+    return "|".join([v if type(v) is str else str(v) for v in vals])
 
 # ---------- Handlers ----------
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -133,62 +242,74 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     )
     await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
 
+# Envíos en curso por (chat, comando, rango): pulsaciones repetidas esperan al primero
+_inflight: Dict[Tuple[Any, ...], "asyncio.Future[None]"] = {}
+
 async def _send_items(update: Update, context: ContextTypes.DEFAULT_TYPE, day_from: date, day_to: date, label: str) -> None:
-    tz = ZoneInfo(TZ)
     chat_id = update.effective_chat.id if update.effective_chat else None
+    key = (chat_id, label, day_from, day_to)
+    pending = _inflight.get(key)
+    if pending is not None:
+        await asyncio.shield(pending)
+        return
+
+    fut: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        await _deliver_items(update, context, chat_id, day_from, day_to, label)
+    finally:
+        del _inflight[key]
+        fut.set_result(None)
 
+async def _deliver_items(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: Optional[int], day_from: date, day_to: date, label: str) -> None:
     provider = get_provider(PROVIDER_NAME)
-    async with httpx.AsyncClient(timeout=httpx.Timeout(6.0)) as client:
-        mem = RestMemory(REDIS_REST_URL, REDIS_REST_TOKEN, client=client) if (REDIS_REST_URL and REDIS_REST_TOKEN) else None
+    client: httpx.AsyncClient = context.application.bot_data["http"]
+    mem = RestMemory(REDIS_REST_URL, REDIS_REST_TOKEN, client=client) if (REDIS_REST_URL and REDIS_REST_TOKEN) else None
 
-        try:
-            items = await provider.get_items(day_from, day_to, top_k=TOP_K)
-        except Exception as e:
-            await update.message.reply_text(f"⚠️ Error al obtener datos del proveedor: {e}")
-            return
+    try:
+        items = await get_items_cached(provider, day_from, day_to, TOP_K)
+    except Exception as e:
+        await update.message.reply_text(f"⚠️ Error al obtener datos del proveedor: {e}")
+        return
 
-        if not items:
-            await update.message.reply_text(f"Sin resultados para {label}.")
-            return
+    # Descarta items mal formados antes de calcular huellas y consultar Upstash
+    valid = [item for item in items if is_valid_item(item)]
+    if len(valid) != len(items):
+        logger.warning("Descartados %d items mal formados del proveedor", len(items) - len(valid))
+    items = valid
 
-        ttl_seconds = max(60, MEMORY_TTL_DAYS * 24 * 3600)
-        sent = 0
-        for item in items:
-            payload = build_fingerprint_payload(item)
-            fp = make_fingerprint(MEMORY_NAMESPACE, str(chat_id), payload)
-            should_skip = False
-            if mem:
-                try:
-                    exists = await mem.exists(fp)
-                    if exists:
-                        should_skip = True
-                    else:
-                        await mem.setex(fp, ttl_seconds, "1")
-                except Exception:
-                    pass
+    if not items:
+        await update.message.reply_text(f"Sin resultados para {label}.")
+        return
 
-            if should_skip:
-                continue
+    ttl_seconds = max(60, MEMORY_TTL_DAYS * 24 * 3600)
+    fps = [make_fingerprint(MEMORY_NAMESPACE, str(chat_id), build_fingerprint_payload(item)) for item in items]
+    claimed = [True] * len(fps)
+    if mem:
+        # Un único round-trip atómico: solo se envían los items cuya huella se reclama aquí,
+        # así dos comandos simultáneos del mismo chat nunca repiten un item
+        try:
+            claimed = await mem.mclaim(fps, ttl_seconds)
+        except Exception:
+            pass
 
-            await update.message.reply_text(fmt_item(item), parse_mode=ParseMode.MARKDOWN)
-            sent += 1
+    fresh = [item for item, ok in zip(items, claimed) if ok]
+    if not fresh:
+        await update.message.reply_text("No hay novedades (todo estaba ya enviado previamente).")
+        return
 
-        if sent == 0:
-            await update.message.reply_text("No hay novedades (todo estaba ya enviado previamente).")
+    await reply_chunks(update, (fmt_item(item) for item in fresh))
 
 async def cmd_today(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    tz = ZoneInfo(TZ)
-    today = datetime.now(tz).date()
+    today = today_local()
     await _send_items(update, context, today, today, "hoy")
 
 async def cmd_tomorrow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    tz = ZoneInfo(TZ)
-    tomorrow = (datetime.now(tz) + timedelta(days=1)).date()
+    tomorrow = today_local() + timedelta(days=1)
     await _send_items(update, context, tomorrow, tomorrow, "mañana")
 
 async def cmd_picks(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    tz = ZoneInfo(TZ)
-    d = (datetime.now(tz) + timedelta(days=DAY_OFFSET_DEFAULT)).date()
+    d = today_local() + timedelta(days=DAY_OFFSET_DEFAULT)
     await _send_items(update, context, d, d, f"día +{DAY_OFFSET_DEFAULT}")
 
 async def cmd_day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -203,15 +324,14 @@ async def cmd_day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await _send_items(update, context, d, d, d.strftime("%d/%m/%Y"))
 
 async def cmd_week(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    tz = ZoneInfo(TZ)
-    start = datetime.now(tz).date()
+    start = today_local()
     end = start + timedelta(days=6)
     await _send_items(update, context, start, end, "próximos 7 días")
 
 async def cmd_meminfo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = (
         "ℹ️ *Memoria (Upstash REST)*\n"
-        "- Se usa deduplicación por huella (SHA-256) con TTL.\n"
+        "- Se usa deduplicación por huella (BLAKE2b) con TTL.\n"
         "- Por limitaciones de REST, no se listan ni borran claves por prefijo.\n"
         "- Tip: cambia `MEMORY_NAMESPACE` para un reset lógico inmediato."
     )
@@ -224,31 +344,66 @@ async def cmd_forgetall(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     )
     await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
 
+# Un único escaneo del universo en curso por proceso; /buyideas concurrentes lo comparten
+_buyideas_scan: Optional["asyncio.Future[List[EvalResult]]"] = None
+
+async def _run_buyideas_scan(client: httpx.AsyncClient, mem: Optional[RestMemory], snap_key: str, cd_key: str, ttl: int) -> List[EvalResult]:
+    provider = get_provider("traderepublic")
+    # Ranking completo: el snapshot sirve a cualquier `n` durante la ventana
+    ideas = await provider.buyideas(client, top_k=len(DEFAULT_UNIVERSE))
+    # Snapshot + cooldown global en un único round-trip
+    if ideas and mem:
+        try:
+            snap = json.dumps([asdict(r) for r in ideas], ensure_ascii=False)
+            await mem.msetex([(snap_key, ttl, snap), (cd_key, ttl, "1")])
+        except Exception:
+            pass
+    return ideas
+
+def _clear_buyideas_scan(fut: "asyncio.Future[List[EvalResult]]") -> None:
+    global _buyideas_scan
+    if _buyideas_scan is fut:
+        _buyideas_scan = None
+    if not fut.cancelled():
+        fut.exception()  # marcada como recuperada aunque ningún llamador siga esperando
+
 async def cmd_buyideas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    global _buyideas_scan
     # Cooldowns (Upstash si está configurado)
     global_cd_key = f"{REDIS_PREFIX}:cd:buyideas:global"
+    snap_key = f"{REDIS_PREFIX}:buyideas:snap"
     per_ticker_cd = 45 * 60  # reservado para futuro
     global_cd = 180 * 60
 
-    async with httpx.AsyncClient(timeout=httpx.Timeout(12.0)) as client:
-        mem = None
-        if REDIS_REST_URL and REDIS_REST_TOKEN:
-            mem = RestMemory(REDIS_REST_URL, REDIS_REST_TOKEN, client=client)
-            try:
-                if await mem.exists(global_cd_key):
-                    await update.message.reply_text("⌛ Enfriando /buyideas (cooldown activo). Prueba más tarde.")
-                    return
-            except Exception:
-                pass
-
-        provider = get_provider("traderepublic")
+    try:
+        n = int(context.args[0]) if context.args else TOP_K
+    except Exception:
+        n = TOP_K
+
+    client: httpx.AsyncClient = context.application.bot_data["http"]
+    ideas: Optional[List[EvalResult]] = None
+    mem = None
+    if REDIS_REST_URL and REDIS_REST_TOKEN:
+        mem = RestMemory(REDIS_REST_URL, REDIS_REST_TOKEN, client=client)
         try:
-            n = int(context.args[0]) if context.args else TOP_K
+            # Dentro de la ventana de cooldown se sirve el último resultado calculado
+            snap = await mem.get(snap_key)
+            if snap:
+                ideas = [EvalResult(**d) for d in json.loads(snap)]
+            elif await mem.exists(global_cd_key):
+                await update.message.reply_text("⌛ Enfriando /buyideas (cooldown activo). Prueba más tarde.")
+                return
         except Exception:
-            n = TOP_K
+            pass
 
+    if ideas is None:
+        if _buyideas_scan is None:
+            _buyideas_scan = asyncio.ensure_future(
+                _run_buyideas_scan(client, mem, snap_key, global_cd_key, global_cd)
+            )
+            _buyideas_scan.add_done_callback(_clear_buyideas_scan)
         try:
-            ideas = await provider.buyideas(client, top_k=n)
+            ideas = await asyncio.shield(_buyideas_scan)
         except Exception as e:
             await update.message.reply_text(f"⚠️ Error al generar ideas: {e}")
             return
@@ -257,23 +412,8 @@ async def cmd_buyideas(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             await update.message.reply_text("Sin ideas claras ahora mismo.")
             return
 
-        # Mensajes (con emojis)
-        for r in ideas:
-            txt = (
-                f"💡 *{r.symbol}* ({r.name}) — {r.price:.2f}\n"
-                f"{deco_decision(r.decision)} | Horizonte: {deco_horizon(r.horizonte)}\n"
-                f"🧮 Score: *{r.score}/100* | 🤝 Confianza: {deco_conf(r.confianza)} | ⚖️ Riesgo: {deco_risk(r.riesgo_cat)}\n"
-                f"🧠 Razón: {r.razon}\n"
-                f"{DISCLAIMER}"
-            )
-            await update.message.reply_text(txt, parse_mode=ParseMode.MARKDOWN)
-
-        # Cooldown global
-        if mem:
-            try:
-                await mem.setex(global_cd_key, global_cd, "1")
-            except Exception:
-                pass
+    # Mensajes (con emojis), agrupados; cada mensaje lleva el aviso
+    await reply_chunks(update, (fmt_eval(r, "💡") for r in ideas[:max(1, n)]), footer=DISCLAIMER)
 
 async def cmd_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not context.args:
@@ -286,30 +426,38 @@ async def cmd_check(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Acepta nombres con espacios
     query = " ".join(context.args).strip()
 
-    async with httpx.AsyncClient(timeout=httpx.Timeout(12.0)) as client:
-        provider = get_provider("traderepublic")
-        try:
-            r = await provider.evaluate(client, query)
-        except Exception as e:
-            await update.message.reply_text(f"⚠️ Error al evaluar {query}: {e}")
-            return
+    client: httpx.AsyncClient = context.application.bot_data["http"]
+    provider = get_provider("traderepublic")
+    try:
+        r = await provider.evaluate(client, query)
+    except Exception as e:
+        await update.message.reply_text(f"⚠️ Error al evaluar {query}: {e}")
+        return
 
-        if not r:
-            await update.message.reply_text(f"No se pudo evaluar '{query}'. Comprueba el ticker/ISIN.")
-            return
+    if not r:
+        await update.message.reply_text(f"No se pudo evaluar '{query}'. Comprueba el ticker/ISIN.")
+        return
 
-        txt = (
-            f"📊 *{r.symbol}* ({r.name}) — {r.price:.2f}\n"
-            f"{deco_decision(r.decision)} | Horizonte: {deco_horizon(r.horizonte)}\n"
-            f"🧮 Score: *{r.score}/100* | 🤝 Confianza: {deco_conf(r.confianza)} | ⚖️ Riesgo: {deco_risk(r.riesgo_cat)}\n"
-            f"🧠 Razón: {r.razon}\n"
-            f"{DISCLAIMER}"
-        )
-        await update.message.reply_text(txt, parse_mode=ParseMode.MARKDOWN)
+    await update.message.reply_text(f"{fmt_eval(r, '📊')}\n{DISCLAIMER}", parse_mode=ParseMode.MARKDOWN)
 
 # ---------- App ----------
+async def _close_http(app: Application) -> None:
+    client = app.bot_data.pop("http", None)
+    if client is not None:
+        await client.aclose()
+
 def build_app() -> Application:
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # HTTP/2: los reply_text concurrentes se multiplexan sobre una sola conexión
+        .request(HTTPXRequest(http_version="2", connection_pool_size=32))
+        .concurrent_updates(True)  # un /buyideas lento no bloquea al resto de chats
+        .post_shutdown(_close_http)
+        .build()
+    )
+    # Cliente HTTP compartido (keep-alive + HTTP/2) para Upstash/Finnhub/Yahoo
+    app.bot_data["http"] = make_client()
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("today", cmd_today))
     app.add_handler(CommandHandler("tomorrow", cmd_tomorrow))
@@ -322,23 +470,58 @@ def build_app() -> Application:
     app.add_handler(CommandHandler("check", cmd_check))
     return app
 
+async def run_webhook(app: Application, url: str) -> None:
+    """Sirve el webhook de Telegram y /healthz desde un único proceso ASGI (uvicorn)."""
+    async def telegram_update(request: Request) -> Response:
+        await app.update_queue.put(Update.de_json(await request.json(), app.bot))
+        return Response()
+
+    async def healthz(_: Request) -> PlainTextResponse:
+        return PlainTextResponse("ok")
+
+    @asynccontextmanager
+    async def lifespan(_: Starlette):
+        # uvicorn ejecuta el shutdown del lifespan antes de que serve() vuelva y re-emita
+        # la señal capturada (SIGTERM en cada redeploy de Render): la limpieza va aquí
+        try:
+            async with app:
+                await app.bot.set_webhook(f"{url}/{WEBHOOK_PATH}")
+                await app.start()
+                try:
+                    yield
+                finally:
+                    await app.stop()
+        finally:
+            # post_shutdown solo lo invocan run_polling/run_webhook de PTB
+            await _close_http(app)
+
+    web = Starlette(
+        routes=[
+            Route(f"/{WEBHOOK_PATH}", telegram_update, methods=["POST"]),
+            Route("/healthz", healthz, methods=["GET"]),
+        ],
+        lifespan=lifespan,
+    )
+    # lifespan="on": un fallo al arrancar (p. ej. set_webhook) detiene el servidor en vez de ignorarse
+    server = uvicorn.Server(uvicorn.Config(web, host="0.0.0.0", port=PORT, log_level="warning", lifespan="on"))
+    await server.serve()
+
 def main() -> None:
+    try:
+        import uvloop  # opcional: event loop más rápido (no disponible en Windows)
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())  # uvloop.install() está deprecado en 3.12
+    except ImportError:
+        pass
+
     app = build_app()
 
     if WEBHOOK_URL:
-        url = WEBHOOK_URL.rstrip("/")
-        path = WEBHOOK_PATH  # NO usamos el token como path
-        full = f"{url}/{path}"
+        url = WEBHOOK_URL.rstrip("/")  # el path es WEBHOOK_PATH, NO el token
 
         # No exponemos token/path reales en logs
         logger.info("Starting webhook at %s/<redacted>", url)
 
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path=path,
-            webhook_url=full,
-        )
+        asyncio.run(run_webhook(app, url))
         return
 
     # Fallback a polling si no hay URL pública
@@ -1,36 +1,47 @@
 from __future__ import annotations
+import hashlib
+from typing import Any, Iterable, List, Optional, Tuple
 import httpx
 
+try:
+    from orjson import loads as _loads
+except ImportError:  # orjson es opcional
+    from json import loads as _loads
+
 def make_fingerprint(namespace: str, user_id: str, payload: str) -> str:
-    raw = f"{namespace}:{user_id}:{payload}".encode("utf-8")
-    import hashlib as _h
-    return _h.sha256(raw).hexdigest()
+    # Solo deduplicación (no seguridad): BLAKE2b de 128 bits -> clave de 32 hex (vs 64 de SHA-256)
+    raw = b"%b:%b:%b" % (namespace.encode(), user_id.encode(), payload.encode())
+    return hashlib.blake2b(raw, digest_size=16, usedforsecurity=False).hexdigest()
 
 class RestMemory:
-    def __init__(self, base_url: str, token: str, client: httpx.AsyncClient | None = None) -> None:
+    def __init__(self, base_url: str, token: str, client: httpx.AsyncClient) -> None:
+        # `client` es el compartido de la app (make_client): keep-alive, HTTP/2 y reintentos de conexión
         self.base_url = base_url.rstrip("/")
         self.token = token
         self._client = client
-    @property
-    def headers(self) -> dict:
-        return {"Authorization": f"Bearer {self.token}"}
+        self._hdrs = {"Authorization": f"Bearer {token}"}
+    async def _post(self, url: str, body: Any) -> Any:
+        # Comandos como array JSON en el cuerpo: sin construir/escapar rutas con claves o valores
+        r = await self._client.post(url, json=body, headers=self._hdrs)
+        r.raise_for_status()
+        return _loads(r.content)
+    async def _command(self, *args: Any) -> Any:
+        return (await self._post(self.base_url, list(args))).get("result")
     async def exists(self, key: str) -> bool:
-        client = self._client or httpx.AsyncClient()
-        close = self._client is None
-        try:
-            r = await client.post(f"{self.base_url}/exists/{key}", headers=self.headers)
-            r.raise_for_status()
-            return bool(r.json().get("result"))
-        finally:
-            if close:
-                await client.aclose()
+        return bool(await self._command("EXISTS", key))
     async def setex(self, key: str, ttl_seconds: int, value: str) -> bool:
-        client = self._client or httpx.AsyncClient()
-        close = self._client is None
-        try:
-            r = await client.post(f"{self.base_url}/setex/{key}/{ttl_seconds}/{value}", headers=self.headers)
-            r.raise_for_status()
-            return r.json().get("result") == "OK"
-        finally:
-            if close:
-                await client.aclose()
+        return await self._command("SETEX", key, ttl_seconds, value) == "OK"
+    async def get(self, key: str) -> Optional[str]:
+        return await self._command("GET", key)
+    async def _pipeline(self, commands: List[list]) -> List[dict]:
+        """Envía varios comandos en un único POST a /pipeline (un solo round-trip)."""
+        if not commands:
+            return []
+        return await self._post(f"{self.base_url}/pipeline", commands)
+    async def mclaim(self, keys: List[str], ttl_seconds: int, value: str = "1") -> List[bool]:
+        """SET NX EX en lote: True solo para las claves que no existían (reclamo atómico por clave)."""
+        res = await self._pipeline([["SET", k, value, "EX", ttl_seconds, "NX"] for k in keys])
+        return [x.get("result") == "OK" for x in res]
+    async def msetex(self, triples: Iterable[Tuple[str, int, str]]) -> List[bool]:
+        res = await self._pipeline([["SETEX", k, ttl, v] for k, ttl, v in triples])
+        return [x.get("result") == "OK" for x in res]
@@ -1,25 +1,30 @@
 from __future__ import annotations
 from datetime import date, timedelta
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from .base import BaseProvider
 
 class DummyProvider(BaseProvider):
+    # Plantillas precalculadas; solo la fecha cambia por día
+    _TEMPLATES: Tuple[Dict[str, Any], ...] = tuple(
+        {
+            "league": "DUMMY",
+            "name": f"Producto/Evento {idx}",
+            "market": "Tipo",
+            "selection": f"Opción {idx}",
+            "price": f"{1.00 + idx/10:.2f}",
+            "source": "dummy",
+            "value": (idx - 3) * 0.01,
+        }
+        for idx in range(1, 6)
+    )
+
     async def get_items(self, day_from: date, day_to: date, top_k: Optional[int] = None) -> List[Dict[str, Any]]:
         items: List[Dict[str, Any]] = []
         d = day_from
         while d <= day_to:
-            for idx in range(1, 6):
-                items.append({
-                    "date": d.strftime("%Y-%m-%d"),
-                    "league": "DUMMY",
-                    "name": f"Producto/Evento {idx}",
-                    "market": "Tipo",
-                    "selection": f"Opción {idx}",
-                    "price": f"{1.00 + idx/10:.2f}",
-                    "source": "dummy",
-                    "value": (idx - 3) * 0.01,
-                })
+            iso = d.isoformat()
+            items.extend({"date": iso, **t} for t in self._TEMPLATES)
             d += timedelta(days=1)
         if top_k and top_k > 0:
             items = items[:top_k]
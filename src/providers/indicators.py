@@ -0,0 +1,114 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+# Indicadores y señales S1/S2/S3 sobre series float64 (np.ndarray), en un único paso por símbolo.
+
+@dataclass(frozen=True, slots=True)
+class Thresholds:
+    ret1d_min: float = 0.01     # S1: subida diaria mínima
+    ret5d_min: float = 0.03     # S1: subida a 5 sesiones mínima
+    ma20_mult: float = 1.005    # S1: cierre por encima de MA20 con margen
+    s3_drop: float = -0.01      # S3: caída diaria máxima
+    vol_low: float = 0.015      # ATR/precio por debajo -> riesgo Bajo
+    vol_high: float = 0.03      # ATR/precio por encima -> riesgo Alto
+    w_s1: int = 40              # peso de S1 en el score
+    w_s2: int = 50              # peso de S2 en el score
+    w_risk: int = 30            # penalización máxima por riesgo
+
+THRESHOLDS = Thresholds()
+
+class WindowMeans:
+    """Medias de cualquier ventana close[a:b] en O(1) tras una única suma acumulada."""
+
+    def __init__(self, vals: np.ndarray) -> None:
+        self.n = vals.size
+        self._cs = np.concatenate(([0.0], np.cumsum(vals)))
+
+    def mean(self, a: int, b: int) -> float:
+        return float(self._cs[b] - self._cs[a]) / (b - a)
+
+    def sma(self, k: int) -> Optional[float]:
+        """Media de las últimas `k` barras (None si no hay suficientes)."""
+        if self.n < k:
+            return None
+        return self.mean(self.n - k, self.n)
+
+def ret(values: np.ndarray, k: int) -> Optional[float]:
+    if values.size <= k or values[-k-1] == 0:
+        return None
+    return float(values[-1] / values[-k-1]) - 1.0
+
+def atr14(high: np.ndarray, low: np.ndarray, close: np.ndarray) -> Optional[float]:
+    if close.size < 15:
+        return None
+    # Solo se usan los 14 últimos TR: trabajo constante, independiente de la longitud de la serie
+    h, l, cprev = high[-14:], low[-14:], close[-15:-1]
+    tr = np.maximum.reduce([h - l, np.abs(h - cprev), np.abs(l - cprev)])
+    return float(tr.mean())
+
+def trend_parts(close: np.ndarray, wm: Optional[WindowMeans] = None) -> int:
+    """Partes de S2 que no dependen del benchmark: tendencia (precio > MA50 > MA200) y pendiente de MA50."""
+    wm = wm or WindowMeans(close)
+    ma50 = wm.sma(50)
+    ma200 = wm.sma(200)
+    parts = 0
+    if ma50 is not None and ma200 is not None and float(close[-1]) > ma50 > ma200:
+        parts += 1
+    # Pendiente MA50 positiva (aprox): media(-50:) > media(-60:-10) equivale a comparar las
+    # 10 barras que entran con las 10 que salen; exacto en empates, sin error de la suma acumulada
+    if close.size >= 260 and float(close[-10:].sum()) > float(close[-60:-50].sum()):
+        parts += 1
+    return parts
+
+# Posiciones de la barra base para los retornos 1D, 5D y 63D
+_RET_IDX = np.array([-2, -6, -64])
+
+def compute_signals(
+    close: np.ndarray,
+    high: np.ndarray,
+    low: np.ndarray,
+    bench_ret63: Optional[float],
+) -> Dict[str, Any]:
+    """Calcula medias, retornos, ATR y las señales S1/S2/S3 de una vez (requiere close.size >= 30)."""
+    wm = WindowMeans(close)
+    ma20 = wm.sma(20)
+    last, prev = float(close[-1]), float(close[-2])
+
+    # Retornos 1D/5D/63D en una sola división (63D solo si hay historia suficiente)
+    base = close[_RET_IDX if close.size > 63 else _RET_IDX[:2]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rets = np.where(base != 0, last / base - 1.0, np.nan)
+    ret1d = 0.0 if np.isnan(rets[0]) else float(rets[0])
+    ret5d = 0.0 if np.isnan(rets[1]) else float(rets[1])
+    sym_ret63 = float(rets[2]) if rets.size == 3 and not np.isnan(rets[2]) else None
+
+    t = THRESHOLDS
+    s1 = ((ret1d >= t.ret1d_min) or (ret5d >= t.ret5d_min)) and (ma20 is not None and last > t.ma20_mult * ma20)
+
+    s2_parts = trend_parts(close, wm)
+    rs_ok = False
+    if bench_ret63 is not None and sym_ret63 is not None:
+        rs_ok = (sym_ret63 - bench_ret63) > 0.0
+    if rs_ok:
+        s2_parts += 1
+    s2 = s2_parts >= 2
+
+    # S3: caída y cruce bajo MA20 (ayer >= MA20 y hoy < MA20 con ret1d <= -1%)
+    s3 = False
+    if ma20 is not None and close.size >= 21:
+        yesterday_above = prev >= ma20
+        today_below = last < ma20 and (ret1d <= t.s3_drop)
+        s3 = yesterday_above and today_below
+
+    return {
+        "ret1d": ret1d,
+        "ret5d": ret5d,
+        "s1": s1,
+        "s2": s2,
+        "s2_parts": s2_parts,
+        "s3": s3,
+        "atr": atr14(high, low, close),
+    }
@@ -1,13 +1,24 @@
 from __future__ import annotations
 
+import asyncio
 import os
+import random
+import sys
+import time
 from dataclasses import dataclass
-from datetime import datetime, date
-from typing import Any, Dict, List, Optional, Tuple
+from datetime import datetime, date, timedelta, timezone
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
 
 import httpx
+import numpy as np
 
 from .base import BaseProvider
+from .indicators import THRESHOLDS, compute_signals, ret, trend_parts
+
+try:
+    from orjson import loads as _loads
+except ImportError:  # orjson es opcional
+    from json import loads as _loads
 
 # === Config ===
 FINNHUB_API_KEY = os.getenv("FINNHUB_API_KEY", "").strip()
@@ -15,37 +26,62 @@ BENCHMARK = os.getenv("BENCHMARK", "SPY").strip()
 
 # Universo para /buyideas (puedes sobreescribir con UNIVERSE_TICKERS en ENV)
 _UNIVERSE_ENV = [s.strip() for s in os.getenv("UNIVERSE_TICKERS", "").split(",") if s.strip()]
-DEFAULT_UNIVERSE = _UNIVERSE_ENV or [
+DEFAULT_UNIVERSE: Tuple[str, ...] = tuple(sys.intern(s) for s in (_UNIVERSE_ENV or [
     "AAPL","MSFT","NVDA","AMZN","GOOGL","META","TSLA","AVGO","AMD","NFLX","ADBE","COST","PEP","ORCL",
     "SPY","QQQ","IWM","VTI","VOO","EFA","EEM",
     "ASML","SAP","NVO"
-]
+]))
 
 HEADERS = {"X-Finnhub-Token": FINNHUB_API_KEY} if FINNHUB_API_KEY else {}
 
-# === Utils ===
-def _sma(vals: List[float], n: int) -> Optional[float]:
-    if len(vals) < n:
-        return None
-    return sum(vals[-n:]) / n
+# Días naturales de velas a pedir. Las señales necesitan >= 260 sesiones (MA200 y la
+# pendiente de MA50 sobre [-60:-10] se activan con len >= 260); 400 días naturales
+# ≈ 275 sesiones descontando fines de semana y festivos. Con 300 días (~206 sesiones)
+# la pendiente no llegaría a calcularse nunca.
+CANDLE_DAYS = 400
 
-def _ret(values: List[float], k: int) -> Optional[float]:
-    if len(values) <= k or values[-k-1] == 0:
-        return None
-    return (values[-1] / values[-k-1]) - 1.0
+# Máximo de símbolos evaluándose a la vez en /buyideas (respeta el límite de Finnhub)
+SCAN_CONCURRENCY = int(os.getenv("SCAN_CONCURRENCY", "10"))
 
-def _atr14(high: List[float], low: List[float], close: List[float]) -> Optional[float]:
-    n = len(close)
-    if n < 15:
-        return None
-    trs: List[float] = []
-    for i in range(1, n):
-        h, l, cprev = high[i], low[i], close[i-1]
-        tr = max(h - l, abs(h - cprev), abs(l - cprev))
-        trs.append(tr)
-    if len(trs) < 14:
-        return None
-    return sum(trs[-14:]) / 14.0
+def make_client() -> httpx.AsyncClient:
+    """
+    Cliente de larga vida (keep-alive + HTTP/2) para evaluate/buyideas.
+    Créalo una vez al arrancar y reutilízalo: uno por llamada paga un handshake TLS por petición.
+    El token de Finnhub se añade por petición en _fh_json (no como cabecera por defecto,
+    para no enviarlo a Yahoo/Stooq/Upstash).
+    """
+    return httpx.AsyncClient(
+        timeout=20.0,
+        # Con transport explícito, httpx ignora http2/limits del cliente: van en el transport.
+        # Reintenta fallos de conexión transitorios (httpx no reintenta respuestas 5xx)
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        ),
+    )
+
+# === Utils ===
+# Las series OHLC viajan como np.ndarray float64 (una por campo) desde _candles hasta las señales
+def _ohlc(c: Any, h: Any, l: Any) -> Dict[str, Any]:
+    return {
+        "s": "ok",
+        "c": np.asarray(c, dtype=np.float64),
+        "h": np.asarray(h, dtype=np.float64),
+        "l": np.asarray(l, dtype=np.float64),
+    }
+
+# Peticiones simultáneas a Finnhub y reintentos ante 429/5xx (límite del plan gratuito: 60 req/min)
+_FH_SEM = asyncio.Semaphore(int(os.getenv("FINNHUB_CONCURRENCY", "8")))
+_FH_RETRY_STATUS = (429, 500, 502, 503, 504)
+_FH_ATTEMPTS = 4
+
+def _retry_delay(resp: httpx.Response, attempt: int) -> float:
+    """Respeta Retry-After si viene; si no, backoff exponencial con jitter."""
+    try:
+        return min(float(resp.headers.get("Retry-After", "")), 30.0)
+    except ValueError:
+        return min(2 ** attempt, 8) + random.random()
 
 async def _fh_json(client: httpx.AsyncClient, url: str, params: Dict[str, Any]) -> Dict[str, Any]:
     """GET a Finnhub endpoint ensuring token is in query and raising useful errors."""
@@ -53,26 +89,42 @@ async def _fh_json(client: httpx.AsyncClient, url: str, params: Dict[str, Any])
         raise RuntimeError("FINNHUB_API_KEY vacío")
     q = dict(params or {})
     q["token"] = FINNHUB_API_KEY
-    try:
-        r = await client.get(url, params=q, headers=HEADERS, timeout=20.0)
-        r.raise_for_status()
-        return r.json()
-    except httpx.HTTPStatusError as e:
-        # Propaga info útil (401/429/etc.)
-        body = e.response.text[:200] if e.response is not None else str(e)
-        raise RuntimeError(f"finnhub {e.response.status_code}: {body}")
-    except Exception as e:
-        raise RuntimeError(f"finnhub error: {e}")
-
-async def _candles(client: httpx.AsyncClient, symbol: str, days: int = 420) -> Dict[str, Any]:
+    for attempt in range(_FH_ATTEMPTS):
+        try:
+            async with _FH_SEM:
+                r = await client.get(url, params=q, headers=HEADERS, timeout=20.0)
+            r.raise_for_status()
+            return _loads(r.content)
+        except httpx.HTTPStatusError as e:
+            status = e.response.status_code
+            if status in _FH_RETRY_STATUS and attempt < _FH_ATTEMPTS - 1:
+                await asyncio.sleep(_retry_delay(e.response, attempt))
+                continue
+            # Propaga info útil (401/429/etc.)
+            raise RuntimeError(f"finnhub {status}: {e.response.text[:200]}")
+        except Exception as e:
+            raise RuntimeError(f"finnhub error: {e}")
+    raise RuntimeError("finnhub: reintentos agotados")
+
+def _day_end_ts() -> int:
+    """Fin del día UTC en curso: `end` estable durante el día -> URLs idénticas y cacheables."""
+    d = datetime.now(timezone.utc).date() + timedelta(days=1)
+    return int(datetime(d.year, d.month, d.day, tzinfo=timezone.utc).timestamp())
+
+async def _candles(
+    client: httpx.AsyncClient,
+    symbol: str,
+    days: int = CANDLE_DAYS,
+    end_ts: Optional[int] = None,
+) -> Dict[str, Any]:
     """
     1) Finnhub (si plan/permite)
     2) Yahoo (con User-Agent)
     3) Stooq (CSV) como último recurso
     """
+    end = end_ts or _day_end_ts()
     # 1) Finnhub
     try:
-        end = int(datetime.utcnow().timestamp())
         start = end - days * 86400
         js = await _fh_json(
             client,
@@ -80,7 +132,7 @@ async def _candles(client: httpx.AsyncClient, symbol: str, days: int = 420) -> D
             {"symbol": symbol, "resolution": "D", "from": start, "to": end},
         )
         if js.get("s") == "ok":
-            return js
+            return _ohlc(js["c"], js["h"], js["l"])
         # Si no es ok, forzamos fallback
         raise RuntimeError(f"candles finnhub estado={js.get('s')}")
     except Exception:
@@ -88,40 +140,39 @@ async def _candles(client: httpx.AsyncClient, symbol: str, days: int = 420) -> D
 
     # 2) Yahoo
     try:
-        return await _candles_yahoo(client, symbol, days=days)
+        return await _candles_yahoo(client, symbol, days=days, end_ts=end)
     except httpx.HTTPStatusError as e:
         if e.response is not None and e.response.status_code == 429:
             # 3) Stooq si Yahoo nos rate-limita
-            return await _candles_stooq(client, symbol, days=days)
+            return await _candles_stooq(client, symbol, days=days, end_ts=end)
         raise
     except Exception:
         # 3) Stooq si Yahoo falla por cualquier otro motivo
-        return await _candles_stooq(client, symbol, days=days)
+        return await _candles_stooq(client, symbol, days=days, end_ts=end)
 
 async def _quote(client: httpx.AsyncClient, symbol: str) -> Dict[str, Any]:
     return await _fh_json(client, "https://finnhub.io/api/v1/quote", {"symbol": symbol})
 
-async def _candles_yahoo(client: httpx.AsyncClient, symbol: str, days: int = 420) -> Dict[str, Any]:
+async def _candles_yahoo(
+    client: httpx.AsyncClient,
+    symbol: str,
+    days: int = CANDLE_DAYS,
+    end_ts: Optional[int] = None,
+) -> Dict[str, Any]:
     """
     Fallback a Yahoo Finance para velas diarias cuando Finnhub falla.
     Devuelve dict con keys c,h,l y s="ok".
     """
-    # Rango según days
-    if days <= 365:
-        rng = "1y"
-    elif days <= 730:
-        rng = "2y"
-    elif days <= 1825:
-        rng = "5y"
-    else:
-        rng = "10y"
+    # Ventana exacta (como en Finnhub) en lugar de range=1y/2y/..., que siempre sobrepide
+    end = end_ts or _day_end_ts()
+    start = end - days * 86400
 
     url = f"https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
-    params = {"interval": "1d", "range": rng}
+    params = {"interval": "1d", "period1": start, "period2": end, "events": "history"}
     headers = {"User-Agent": "Mozilla/5.0"}
     r = await client.get(url, params=params, headers=headers, timeout=20.0)
     r.raise_for_status()
-    js = r.json()
+    js = _loads(r.content)
     res = (js.get("chart", {}).get("result") or [None])[0]
     if not res:
         raise RuntimeError("yahoo: sin resultado")
@@ -131,18 +182,23 @@ async def _candles_yahoo(client: httpx.AsyncClient, symbol: str, days: int = 420
     c_raw = q.get("close") or []
     h_raw = q.get("high") or []
     l_raw = q.get("low") or []
-    c, h, l = [], [], []
-    for ci, hi, li in zip(c_raw, h_raw, l_raw):
-        if ci is None or hi is None or li is None:
-            continue
-        c.append(float(ci))
-        h.append(float(hi))
-        l.append(float(li))
-    if len(c) < 30:
+    n = min(len(c_raw), len(h_raw), len(l_raw))
+    # None -> NaN al convertir a float64; se descartan las barras con algún hueco
+    c = np.array(c_raw[:n], dtype=np.float64)
+    h = np.array(h_raw[:n], dtype=np.float64)
+    l = np.array(l_raw[:n], dtype=np.float64)
+    m = ~(np.isnan(c) | np.isnan(h) | np.isnan(l))
+    c, h, l = c[m], h[m], l[m]
+    if c.size < 30:
         raise RuntimeError("yahoo: serie demasiado corta")
-    return {"s": "ok", "c": c, "h": h, "l": l}
-
-async def _candles_stooq(client: httpx.AsyncClient, symbol: str, days: int = 420) -> Dict[str, Any]:
+    return _ohlc(c, h, l)
+
+async def _candles_stooq(
+    client: httpx.AsyncClient,
+    symbol: str,
+    days: int = CANDLE_DAYS,
+    end_ts: Optional[int] = None,
+) -> Dict[str, Any]:
     """
     Segundo fallback: Stooq CSV gratuito (no requiere API key).
     Para tickers USA: aapl.us, spy.us, qqq.us...
@@ -157,7 +213,10 @@ async def _candles_stooq(client: httpx.AsyncClient, symbol: str, days: int = 420
 
     s = map_stooq(symbol)
     url = "https://stooq.com/q/d/l/"
-    params = {"s": s, "i": "d"}
+    # d1/d2 acotan el CSV (sin ellos Stooq devuelve toda la historia del valor)
+    d2 = datetime.fromtimestamp(end_ts or _day_end_ts(), timezone.utc).date()
+    d1 = d2 - timedelta(days=days)
+    params = {"s": s, "i": "d", "d1": d1.strftime("%Y%m%d"), "d2": d2.strftime("%Y%m%d")}
     r = await client.get(url, params=params, timeout=20.0)
     r.raise_for_status()
     text = r.text.strip()
@@ -179,10 +238,41 @@ async def _candles_stooq(client: httpx.AsyncClient, symbol: str, days: int = 420
         c.append(close); h.append(high); l.append(low)
     if len(c) < 30:
         raise RuntimeError("stooq: serie demasiado corta")
-    return {"s": "ok", "c": c, "h": h, "l": l}
+    return _ohlc(c, h, l)
+
+async def _bench_ret63(client: httpx.AsyncClient, end_ts: Optional[int] = None) -> Optional[float]:
+    """Retorno a 63 sesiones del benchmark (para fuerza relativa); None si falla."""
+    try:
+        bench_cd = await _candles(client, BENCHMARK, days=CANDLE_DAYS, end_ts=end_ts)
+        return ret(bench_cd["c"], 63)
+    except Exception:
+        return None  # si falla benchmark, seguimos sin RS
+
+# Caché en memoria de /search: query -> (ts, (symbol, description)); el universo de símbolos cambia poco
+SEARCH_CACHE_TTL = 30 * 86400
+_SEARCH_CACHE_MAX = 1024
+_search_cache: Dict[str, Tuple[float, Tuple[str, str]]] = {}
 
 async def _search_symbol(client: httpx.AsyncClient, query: str) -> Optional[Tuple[str, str]]:
     """Devuelve (symbol, description). Acepta ticker o ISIN."""
+    key = query.strip().upper()
+    hit = _search_cache.get(key)
+    if hit and time.monotonic() - hit[0] < SEARCH_CACHE_TTL:
+        return hit[1]
+    found = await _search_symbol_api(client, query)
+    if found:
+        if len(_search_cache) >= _SEARCH_CACHE_MAX:
+            _search_cache.pop(next(iter(_search_cache)))  # el más antiguo
+        _search_cache[key] = (time.monotonic(), found)
+    return found
+
+def _known_symbol(ticker: str) -> Tuple[str, str]:
+    """Ticker ya validado (universo): sin /search; usa la descripción cacheada si existe."""
+    key = ticker.strip().upper()
+    hit = _search_cache.get(key)
+    return hit[1] if hit else (key, key)
+
+async def _search_symbol_api(client: httpx.AsyncClient, query: str) -> Optional[Tuple[str, str]]:
     js = await _fh_json(client, "https://finnhub.io/api/v1/search", {"q": query})
     res = js.get("result") or []
     if not res:
@@ -217,66 +307,20 @@ class TradeRepublicProvider(BaseProvider):
         return []
 
     # -------- Señales ----------
-    def _signals(
-        self,
-        close: List[float],
-        ma20: Optional[float],
-        ma50: Optional[float],
-        ma200: Optional[float],
-        bench_ret63: Optional[float],
-        sym_ret63: Optional[float],
-    ) -> Dict[str, Any]:
-        ret1d = _ret(close, 1) or 0.0
-        ret5d = _ret(close, 5) or 0.0
-
-        s1 = ((ret1d >= 0.01) or (ret5d >= 0.03)) and (ma20 is not None and close[-1] > 1.005 * ma20)
-
-        s2_parts = 0
-        if ma50 is not None and ma200 is not None and close[-1] > ma50 > ma200:
-            s2_parts += 1
-        # Pendiente MA50 positiva (aprox)
-        s2_slope = False
-        if len(close) >= 260:
-            recent = sum(close[-50:]) / 50.0
-            old = sum(close[-60:-10]) / 50.0
-            s2_slope = recent > old
-        if s2_slope:
-            s2_parts += 1
-        rs_ok = False
-        if bench_ret63 is not None and sym_ret63 is not None:
-            rs_ok = (sym_ret63 - bench_ret63) > 0.0
-        if rs_ok:
-            s2_parts += 1
-        s2 = s2_parts >= 2
-
-        # S3: caída y cruce bajo MA20 (ayer >= MA20 y hoy < MA20 con ret1d <= -1%)
-        s3 = False
-        if ma20 is not None and len(close) >= 21:
-            yesterday_above = close[-2] >= ma20
-            today_below = close[-1] < ma20 and (ret1d <= -0.01)
-            s3 = yesterday_above and today_below
-
-        return {"ret1d": ret1d, "ret5d": ret5d, "s1": s1, "s2": s2, "s2_parts": s2_parts, "s3": s3}
-
-    def _risk_and_score(
-        self,
-        high: List[float],
-        low: List[float],
-        close: List[float],
-        sig: Dict[str, Any],
-    ) -> Tuple[str, int, str, str]:
-        atr = _atr14(high, low, close)
-        price = close[-1]
+    def _risk_and_score(self, close: np.ndarray, sig: Dict[str, Any]) -> Tuple[str, int, str, str]:
+        t = THRESHOLDS
+        atr = sig["atr"]
+        price = float(close[-1])
         riesgo = "Medio"
         penalty = 0.5
         if atr is not None and price:
             vol = atr / price
-            if vol < 0.015:
+            if vol < t.vol_low:
                 riesgo, penalty = "Bajo", 0.0
-            elif vol > 0.03:
+            elif vol > t.vol_high:
                 riesgo, penalty = "Alto", 1.0
 
-        score_raw = (40 if sig["s1"] else 0) + (50 if sig["s2"] else 0) - int(30 * penalty)
+        score_raw = (t.w_s1 if sig["s1"] else 0) + (t.w_s2 if sig["s2"] else 0) - int(t.w_risk * penalty)
         score = max(0, min(100, score_raw))
 
         if sig["s2"]:
@@ -289,38 +333,52 @@ class TradeRepublicProvider(BaseProvider):
         confianza = "Alta" if sig["s2"] and riesgo != "Alto" else ("Media" if (sig["s1"] or sig["s2"]) else "Baja")
         return riesgo, score, confianza, horizonte
 
-    async def evaluate(self, client: httpx.AsyncClient, query: str) -> Optional[EvalResult]:
+    # evaluate/buyideas esperan un cliente compartido (ver make_client), nunca uno por llamada
+    async def evaluate(
+        self,
+        client: httpx.AsyncClient,
+        query: str,
+        bench_ret63: Optional[float] = None,
+        fetch_bench: bool = True,
+        end_ts: Optional[int] = None,
+        resolve: bool = True,
+        bench: Optional[Awaitable[Optional[float]]] = None,
+    ) -> Optional[EvalResult]:
+        """
+        Si `fetch_bench` es False se usa `bench_ret63` tal cual (ya calculado por el llamador).
+        `bench` (p. ej. la tarea compartida de buyideas) se espera tras recibir velas y cotización.
+        `end_ts` fija el final de la ventana de velas (por defecto, fin del día UTC).
+        Con `resolve=False`, `query` es un ticker válido y se omite la búsqueda en Finnhub.
+        """
         if not FINNHUB_API_KEY:
             raise RuntimeError("Falta FINNHUB_API_KEY")
 
         # Buscar símbolo (acepta ticker o ISIN)
-        sym_desc = await _search_symbol(client, query)
+        sym_desc = await _search_symbol(client, query) if resolve else _known_symbol(query)
         if not sym_desc:
             raise RuntimeError("search: sin resultados para el ticker/ISIN")
         symbol, name = sym_desc
 
-        # Velas del símbolo
-        cd = await _candles(client, symbol, days=420)
-        c, h, l = cd["c"], cd["h"], cd["l"]
-        if not c or len(c) < 30:
-            raise RuntimeError(f"candles: serie demasiado corta len={len(c) if c else 0}")
+        # Velas del símbolo y cotización son independientes: en paralelo
+        cd, qt = await asyncio.gather(
+            _candles(client, symbol, days=CANDLE_DAYS, end_ts=end_ts),
+            _quote(client, symbol),
+        )
 
-        ma20 = _sma(c, 20)
-        ma50 = _sma(c, 50)
-        ma200 = _sma(c, 200)
-        sym_ret63 = _ret(c, 63)
+        c, h, l = cd["c"], cd["h"], cd["l"]
+        if c.size < 30:
+            raise RuntimeError(f"candles: serie demasiado corta len={c.size}")
 
-        # Velas del benchmark (para fuerza relativa)
-        bench_ret63: Optional[float] = None
-        try:
-            bench_cd = await _candles(client, BENCHMARK, days=420)
-            bench_ret63 = _ret(bench_cd["c"], 63) if bench_cd and bench_cd.get("c") else None
-        except Exception:
-            bench_ret63 = None  # si falla benchmark, seguimos sin RS
+        # Benchmark solo si puede cambiar el resultado: sin tendencia ni pendiente,
+        # la fuerza relativa sola no llega a activar S2 (y así no se pide)
+        if bench is not None:
+            bench_ret63 = await bench  # nunca lanza (None si falla)
+        elif fetch_bench:
+            bench_ret63 = await _bench_ret63(client, end_ts) if trend_parts(c) else None
 
         # Señales y métricas
-        sig = self._signals(c, ma20, ma50, ma200, bench_ret63, sym_ret63)
-        riesgo, score, confianza, horizonte = self._risk_and_score(h, l, c, sig)
+        sig = compute_signals(c, h, l, bench_ret63)
+        riesgo, score, confianza, horizonte = self._risk_and_score(c, sig)
 
         # Decisión
         if sig["s3"]:
@@ -333,7 +391,6 @@ class TradeRepublicProvider(BaseProvider):
             decision = "EVITAR"
 
         # Precio actual
-        qt = await _quote(client, symbol)
         price = float(qt.get("c") or c[-1]) if qt else float(c[-1])
 
         # Razón breve
@@ -360,16 +417,29 @@ class TradeRepublicProvider(BaseProvider):
         )
 
     async def buyideas(self, client: httpx.AsyncClient, top_k: int = 5) -> List[EvalResult]:
+        """
+        Evalúa el universo en paralelo. El `client` debe admitir al menos
+        SCAN_CONCURRENCY conexiones (p.ej. httpx.Limits(max_connections=100)).
+        """
         if not FINNHUB_API_KEY:
             raise RuntimeError("Falta FINNHUB_API_KEY")
-        out: List[EvalResult] = []
-        for sym in DEFAULT_UNIVERSE:
-            try:
-                r = await self.evaluate(client, sym)
-                if r and (r.decision in ("COMPRAR", "MANTENER")):
-                    out.append(r)
-            except Exception:
-                # Ignora símbolos con no_data/límites/etc.
-                continue
+        sem = asyncio.Semaphore(SCAN_CONCURRENCY)
+        # El benchmark es común a todo el universo: una sola descarga por escaneo
+        # Misma ventana para todo el escaneo (aunque cruce la medianoche)
+        end_ts = _day_end_ts()
+        # Se descarga mientras avanzan las velas del universo; cada evaluate la espera
+        # justo antes de calcular señales
+        bench_task = asyncio.create_task(_bench_ret63(client, end_ts))
+
+        async def _eval(sym: str) -> Optional[EvalResult]:
+            async with sem:
+                return await self.evaluate(client, sym, fetch_bench=False, end_ts=end_ts, resolve=False, bench=bench_task)
+
+        try:
+            results = await asyncio.gather(*(_eval(sym) for sym in DEFAULT_UNIVERSE), return_exceptions=True)
+        finally:
+            bench_task.cancel()  # no-op si ya terminó
+        # Ignora símbolos con no_data/límites/etc. (llegan como excepción)
+        out = [r for r in results if isinstance(r, EvalResult) and r.decision in ("COMPRAR", "MANTENER")]
         out.sort(key=lambda x: x.score, reverse=True)
         return out[:max(1, top_k)]